@@ -2,12 +2,19 @@ import os
 import subprocess
 import sys
 import re
-import glob
+import functools
+import itertools
+import fnmatch
 import threading
-import datetime # 用于生成带时间戳的文件名
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import queue
+import collections
+import shutil
+import multiprocessing.util
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
-import urllib.parse
+from urllib.parse import quote
 
 # --- 帮助函数：获取用户输入 ---
 def get_user_input(prompt, default=None, input_type=str, choices=None):
@@ -46,73 +53,174 @@ def get_user_input(prompt, default=None, input_type=str, choices=None):
         except ValueError as e:
             print(f"输入无效: {e}。请重试。")
 
+# --- 帮助函数：OK列表中路径的比较键 ---
+def ok_list_key(path_str: str) -> str:
+    """
+    返回用于与OK列表比较的规范化路径字符串 (normpath + normcase)。
+    纯字符串运算，不访问文件系统；要求 path_str 为绝对路径。
+    """
+    return os.path.normcase(os.path.normpath(path_str))
+
 # --- 帮助函数：从最新的OK文件列表加载路径 ---
-def load_previously_ok_files_from_txt(log_dir: Path) -> set:
-    """从日志目录中最新的 'ok_files_*.txt' 加载先前标记为OK的文件绝对路径集合。"""
-    previously_ok_files = set()
+def load_previously_ok_files_from_txt(log_dir: Path) -> frozenset:
+    """
+    从日志目录中最新的 'ok_files_*.txt' 加载先前标记为OK的文件路径，返回由 ok_list_key 规范化后的字符串组成的 frozenset。
+    OK列表中的每一行应为绝对路径 (本脚本写出的OK列表即是如此)，加载时不会再对其调用 resolve()。
+    """
     ok_file_pattern = "ok_files_*.txt"
     
     if not log_dir.exists(): # 如果日志目录本身就不存在
         print(f"提示：日志目录 '{log_dir}' 不存在，无法加载先前的OK文件列表。将处理所有匹配文件。")
-        return previously_ok_files
+        return frozenset()
 
     ok_files = sorted(log_dir.glob(ok_file_pattern), reverse=True) 
     
     if not ok_files:
         print(f"提示：在 '{log_dir}' 未找到先前的OK文件列表 (如 {ok_file_pattern})，将处理所有匹配文件。")
-        return previously_ok_files
+        return frozenset()
 
     latest_ok_file = ok_files[0]
     print(f"正在读取最新的OK文件列表: {latest_ok_file}")
     try:
-        with open(latest_ok_file, "r", encoding="utf-8") as f:
-            for line in f:
-                path_str = line.strip()
-                if path_str:
-                    previously_ok_files.add(Path(path_str).resolve())
+        # 一次性读入整个文件再按行拆分，避免逐行读取的开销
+        previously_ok_files = frozenset(
+            ok_list_key(path_str)
+            for path_str in (line.strip() for line in latest_ok_file.read_text(encoding="utf-8").splitlines())
+            if path_str # 去掉首尾空白后跳过空行 (手工编辑过的列表可能带有多余空格)
+        )
     except Exception as e:
         print(f"警告：读取或解析OK文件列表 '{latest_ok_file}' 时出错: {e}。将处理所有匹配文件。")
-        previously_ok_files.clear()
+        return frozenset()
 
     if previously_ok_files:
         print(f"从 '{latest_ok_file}' 中识别出 {len(previously_ok_files)} 个已OK的文件。")
     return previously_ok_files
 
 
-# --- 核心处理函数：使用010 Editor处理单个文件 ---
-def process_file_with_editor(file_path: Path, editor_exe: Path, template_file: Path, use_noui: bool, use_exit_param: bool, timeout_seconds: int, base_data_dir: Path):
+# --- 帮助函数：基于 os.scandir 的多线程文件发现 ---
+def discover_matching_files(root_dir: str, name_matches, recursive: bool, num_workers: int) -> list:
     """
-    使用010 Editor处理单个文件。
-    返回一个包含处理结果的字典。
+    遍历 root_dir，返回文件名满足 name_matches(name) 的所有文件绝对路径字符串 (已排序)。
+    读取目录是 I/O 密集型操作，因此由 num_workers 个线程从共享的目录队列中取目录并行 os.scandir，
+    发现的子目录再放回队列。类型判断利用 DirEntry 读取目录时已缓存的信息，
+    不会为每个条目额外调用 stat，也不构造 Path 对象。
     """
-    file_path_abs = file_path.resolve() # 确保 file_path 是绝对路径
-    filename_only = file_path_abs.name
-
-    # 计算相对路径 (相对于 base_data_dir)
-    try:
-        # 确保 base_data_dir 也是绝对路径以进行可靠比较
-        relative_p_str = str(file_path_abs.relative_to(base_data_dir.resolve()))
-    except ValueError:
-        # 如果不是子路径（理论上不应发生，除非文件列表构建逻辑有误或 base_data_dir 被错误传递）
-        # 则回退到仅使用文件名，或者可以考虑使用路径的最后几部分
-        relative_p_str = file_path_abs.name 
-        print(f"警告: 文件 '{file_path_abs}' 不在基础数据目录 '{base_data_dir.resolve()}' 的子路径中。相对路径将使用文件名。")
-
-
-    command = [
-        str(editor_exe),
-        str(file_path_abs),
-        f"-template:{template_file}",
-        "-readonly",
-        "-nowarnings"
-    ]
+    dir_queue = queue.Queue()
+    found_files = collections.deque() # deque.extend 是线程安全的
+    dir_queue.put(root_dir)
+
+    def crawl():
+        while True:
+            current_dir = dir_queue.get()
+            if current_dir is None:
+                return
+            try:
+                matched = []
+                with os.scandir(current_dir) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            if recursive:
+                                dir_queue.put(entry.path)
+                        elif entry.is_file(follow_symlinks=False) and name_matches(entry.name):
+                            matched.append(entry.path)
+                found_files.extend(matched)
+            except OSError as e:
+                print(f"警告: 无法读取目录 '{current_dir}': {e}")
+            finally:
+                dir_queue.task_done()
+
+    workers = [threading.Thread(target=crawl, daemon=True) for _ in range(max(1, num_workers))]
+    for worker in workers:
+        worker.start()
+    dir_queue.join() # 所有目录 (包括过程中新加入的子目录) 都已处理完
+    for _ in workers:
+        dir_queue.put(None)
+    for worker in workers:
+        worker.join()
+
+    return sorted(found_files) # 线程完成顺序不确定，排序以保证每次运行的处理顺序一致
+
+
+# --- 工作进程初始化：每个进程只解析一次固定配置 ---
+_worker_editor_exe = None
+_worker_template_file = None
+_worker_base_data_dir = None
+_worker_base_data_prefix = None # 以路径分隔符结尾的 _worker_base_data_dir，用于计算相对路径
+_worker_editor_flags = ()  # 每次启动010 Editor都相同的命令行开关
+_worker_file_command = ()  # 单文件模式的命令模板: (编辑器, -template:..., 开关...)，目标文件插在第二位
+_worker_timeout_seconds = None
+_worker_batch_disabled = False # 批处理脚本报告 ===FATAL=== 后，本进程改为逐个文件处理
+_worker_sort_md_results = False
+_worker_md_f = None    # 本进程的局部日志文件 (每个文件只有本进程写入，无需加锁)
+_worker_ok_f = None
+_worker_error_f = None
+
+def init_worker(editor_exe: Path, template_file: Path, base_data_dir: Path, use_noui: bool, use_exit_param: bool, timeout_seconds: int,
+                partials_dir: Path, sort_md_results: bool):
+    """
+    ProcessPoolExecutor 的 initializer，在每个工作进程启动时预先解析路径、
+    构建固定不变的命令行部分，并保存到模块全局变量中。
+    同时在 partials_dir 中打开本进程专用的局部日志文件 (以进程ID命名)，进程退出时自动关闭。
+    """
+    global _worker_editor_exe, _worker_template_file, _worker_base_data_dir, _worker_base_data_prefix
+    global _worker_editor_flags, _worker_file_command, _worker_timeout_seconds
+    global _worker_sort_md_results, _worker_md_f, _worker_ok_f, _worker_error_f
+    _worker_editor_exe = editor_exe.resolve()
+    _worker_template_file = template_file.resolve()
+    _worker_base_data_dir = str(base_data_dir.resolve())
+    _worker_base_data_prefix = _worker_base_data_dir if _worker_base_data_dir.endswith(os.sep) else _worker_base_data_dir + os.sep
+
+    flags = ["-readonly", "-nowarnings"]
     if use_noui:
-        command.append("-noui")
+        flags.append("-noui")
     if use_exit_param:
-        command.append("-exit")
+        flags.append("-exit")
+    _worker_editor_flags = tuple(flags)
+    _worker_file_command = (str(_worker_editor_exe), f"-template:{_worker_template_file}", *_worker_editor_flags)
+    _worker_timeout_seconds = timeout_seconds
+
+    _worker_sort_md_results = sort_md_results
+    worker_id = os.getpid()
+    _worker_md_f = open(partials_dir / f"md_{worker_id}.part", "w", encoding="utf-8", buffering=LOG_BUFFER_SIZE)
+    _worker_ok_f = open(partials_dir / f"ok_{worker_id}.txt", "w", encoding="utf-8", buffering=LOG_BUFFER_SIZE)
+    _worker_error_f = open(partials_dir / f"error_{worker_id}.txt", "w", encoding="utf-8", buffering=LOG_BUFFER_SIZE)
+    for log_f in (_worker_md_f, _worker_ok_f, _worker_error_f):
+        # 工作进程正常退出时 (进程池关闭) 由 multiprocessing 调用，保证缓冲内容写入磁盘
+        multiprocessing.util.Finalize(None, log_f.close, exitpriority=10)
+
+
+LOG_BUFFER_SIZE = 1 << 20 # 日志文件写缓冲大小 (1 MiB)，减少逐行写入导致的系统调用
+WINDOWS_MAX_WORKERS = 61 # Windows 上 ProcessPoolExecutor 的 max_workers 上限 (超过会抛出 ValueError)
+PROGRESS_PRINT_INTERVAL = 100 # 每完成这么多个文件打印一次进度 (非OK结果总是立即打印)
+
+BATCH_SCRIPT_FILE = Path(__file__).resolve().with_suffix(".1sc") # 批处理模式使用的 010 Editor 脚本
+BATCH_BEGIN_MARK = b"===BEGIN==="
+BATCH_OK_MARK = b"===OK==="
+BATCH_ERR_MARK = b"===ERR==="
+BATCH_FATAL_MARK = b"===FATAL===" # 脚本无法获取或打开列表文件，批处理模式在本环境下不可用
+
+OUTPUT_EXCERPT_BYTES = 4096 # 非OK结果写入日志时，输出只保留开头和结尾各这么多字节
+# 输出中的错误关键词：一次正则扫描代替多次子串查找。
+# bytes 模式下 IGNORECASE 只作用于 ASCII 字母，UTF-8 编码的 "错误" 按原样匹配。
+ERROR_KEYWORD_RE = re.compile(b"error|failed|assert|" + re.escape("错误".encode("utf-8")), re.IGNORECASE)
+
+
+def _new_result(file_path_abs: str) -> dict:
+    """为单个文件 (已是绝对路径字符串) 创建初始结果字典 (状态默认为 ERROR)。"""
+    filename_only = os.path.basename(file_path_abs)
+
+    # 计算相对路径 (相对于 base_data_dir)：发现阶段的路径都是在同一个已解析的根目录字符串上拼接的，
+    # 因此直接去掉前缀即可，无需 stat 或 PurePath 运算
+    if file_path_abs.startswith(_worker_base_data_prefix):
+        relative_p_str = file_path_abs[len(_worker_base_data_prefix):]
+    else:
+        # 如果不是子路径（理论上不应发生，除非文件列表构建逻辑有误或 base_data_dir 被错误传递）
+        # 则回退到仅使用文件名，或者可以考虑使用路径的最后几部分
+        relative_p_str = filename_only
+        print(f"警告: 文件 '{file_path_abs}' 不在基础数据目录 '{_worker_base_data_dir}' 的子路径中。相对路径将使用文件名。")
 
-    result = {
-        "path": str(file_path_abs),
+    return {
+        "path": file_path_abs,
         "filename": filename_only,
         "relative_path": relative_p_str, # 使用新计算的相对路径
         "status": "ERROR",
@@ -120,50 +228,251 @@ def process_file_with_editor(file_path: Path, editor_exe: Path, template_file: P
         "stdout": "",
         "stderr": ""
     }
+
+
+def _decode_output(data: bytes) -> str:
+    """
+    把捕获的原始输出解码为文本，仅在需要写入日志时调用。
+    超过 2 * OUTPUT_EXCERPT_BYTES 字节时只保留开头和结尾部分，避免巨大的输出撑爆日志和内存。
+    """
+    data = data.strip() if data else b""
+    if len(data) > 2 * OUTPUT_EXCERPT_BYTES:
+        omitted = len(data) - 2 * OUTPUT_EXCERPT_BYTES
+        head = data[:OUTPUT_EXCERPT_BYTES].decode('utf-8', 'replace')
+        tail = data[-OUTPUT_EXCERPT_BYTES:].decode('utf-8', 'replace')
+        return f"{head}\n... (省略 {omitted} 字节) ...\n{tail}"
+    return data.decode('utf-8', 'replace')
+
+
+def _classify_result(result: dict, returncode: int, stdout: bytes, stderr: bytes):
+    """
+    根据返回码和输出中的错误关键词设置结果的状态与消息。
+    返回码非0时直接判定为 ERROR，不再扫描关键词；返回码为0时才用 ERROR_KEYWORD_RE 区分 OK 与 POTENTIAL ERROR，
+    且 stdout 命中后不再扫描 stderr。关键词直接在原始 bytes 上扫描；只有非OK结果才会解码输出并保存到 result 中。
+    """
+    stdout = stdout or b""
+    stderr = stderr or b""
+
+    if returncode != 0:
+        result["status"] = "ERROR"
+        result["message"] = f"返回码: {returncode}。请检查输出。"
+    elif ERROR_KEYWORD_RE.search(stdout) or ERROR_KEYWORD_RE.search(stderr):
+        result["status"] = "POTENTIAL ERROR"
+        result["message"] = f"返回码为0，但在输出中找到错误关键词。请检查输出。"
+    else:
+        result["status"] = "OK"
+        result["message"] = "处理成功。"
+        return
+
+    result["stdout"] = _decode_output(stdout)
+    result["stderr"] = _decode_output(stderr)
+
+
+# --- 帮助函数：生成 Markdown 中的 file:/// 链接 ---
+_LINK_SEP_TR = str.maketrans({os.sep: "/"}) # 路径分隔符统一替换为正斜杠
+
+@functools.lru_cache(maxsize=4096)
+def _quote_link_dir(dir_path: str) -> str:
+    """URL编码链接中的目录部分。同一目录下的文件共享结果，因此做缓存。"""
+    return quote(dir_path, safe="/:")
+
+def markdown_file_link(path_str: str, display_name: str) -> str:
+    """返回指向 path_str 的 Markdown 链接 [display_name](file:///...)，路径中的特殊字符会被URL编码。"""
+    dir_part, sep, name = path_str.translate(_LINK_SEP_TR).rpartition("/")
+    return f"[{display_name}](file:///{_quote_link_dir(dir_part)}{sep}{quote(name, safe='/:')})"
+
+
+# --- 帮助函数：生成主日志 (MD) 表格中的一行 ---
+# 表格单元格转义：一次 translate 完成 "|" 转义、换行替换为 <br> 并去掉 "\r"
+_MD_TABLE_TR = str.maketrans({"|": "\\|", "\n": "<br>", "\r": ""})
+
+def format_md_row(result: dict) -> str:
+    """把单个文件的处理结果格式化为 Markdown 表格的一行 (以换行结尾)。"""
+    file_link = markdown_file_link(result['path'], result['filename'])
+
+    details_md = result['message']
+    if result['status'] != "OK":
+        if result['stdout']:
+            details_md += f"<br><br>**标准输出 (Stdout):**<br>```\n{result['stdout']}\n```"
+        if result['stderr']:
+            details_md += f"<br><br>**标准错误 (Stderr):**<br>```\n{result['stderr']}\n```"
+
+    details_md_sanitized = details_md.translate(_MD_TABLE_TR) # 输出已由 _decode_output 截断，单元格不会过大
+    return f"| {result['status']} | {file_link} | {details_md_sanitized} |\n"
+
+
+# --- 核心处理函数：使用010 Editor处理单个文件 ---
+def process_file_with_editor(file_path_abs: str):
+    """
+    使用010 Editor处理单个文件 (在工作进程中运行，需先调用 init_worker)。
+    file_path_abs 必须是绝对路径字符串 (由文件发现阶段生成)。
+    返回一个包含处理结果的字典。
+    """
+    result = _new_result(file_path_abs)
+
+    command = [_worker_file_command[0], file_path_abs, *_worker_file_command[1:]]
     
     try:
         process = subprocess.run(
             command,
-            capture_output=True,
-            text=True,
-            encoding='utf-8',
-            errors='replace',
-            timeout=timeout_seconds
+            capture_output=True, # 以 bytes 捕获输出，不做整段解码
+            timeout=_worker_timeout_seconds
         )
-
-        result["stdout"] = process.stdout.strip() if process.stdout else ""
-        result["stderr"] = process.stderr.strip() if process.stderr else ""
-        stdout_lower = result["stdout"].lower()
-        stderr_lower = result["stderr"].lower()
-
-        has_error_keywords = (
-            "error" in stdout_lower or "failed" in stdout_lower or "错误" in stdout_lower or
-            "error" in stderr_lower or "failed" in stderr_lower or "错误" in stderr_lower or
-            "assert" in stderr_lower
-        )
-
-        if process.returncode == 0 and not has_error_keywords:
-            result["status"] = "OK"
-            result["message"] = "处理成功。"
-        elif process.returncode == 0 and has_error_keywords:
-            result["status"] = "POTENTIAL ERROR"
-            result["message"] = f"返回码为0，但在输出中找到错误关键词。请检查输出。"
-        else:
-            result["status"] = "ERROR"
-            result["message"] = f"返回码: {process.returncode}。请检查输出。"
+        _classify_result(result, process.returncode, process.stdout, process.stderr)
 
     except subprocess.TimeoutExpired:
         result["status"] = "ERROR"
-        result["message"] = f"处理超时（{timeout_seconds}秒）。"
+        result["message"] = f"处理超时（{_worker_timeout_seconds}秒）。"
     except FileNotFoundError: # 主要指 editor_exe
         result["status"] = "ERROR"
-        result["message"] = f"编辑器可执行文件未找到: {editor_exe}"
+        result["message"] = f"编辑器可执行文件未找到: {_worker_editor_exe}"
     except Exception as e:
         result["status"] = "ERROR"
-        result["message"] = f"处理文件 '{file_path_abs.name}' 时发生未知异常: {str(e)}"
+        result["message"] = f"处理文件 '{result['filename']}' 时发生未知异常: {str(e)}"
     return result
 
 
+# --- 核心处理函数：在同一个010 Editor实例中批量处理多个文件 ---
+def process_batch_with_editor(file_paths_abs: list):
+    """
+    使用 BatchTemplateTest.1sc 脚本让一个010 Editor实例依次处理 file_paths_abs (绝对路径字符串) 中的所有文件，
+    从而把编辑器启动开销分摊到整批文件上。返回结果字典列表，顺序与 file_paths_abs 一致。
+
+    010 Editor 脚本无法读取标准输入，因此文件列表通过临时列表文件传给脚本，
+    脚本为每个文件输出 ===BEGIN=== 与 ===OK===/===ERR=== 标记。
+    未被脚本开始处理的文件 (例如脚本中途退出) 会回退到逐个文件启动的方式。
+    stderr 无法对应到具体文件，因此当整批的 stderr 命中错误关键词或返回码非0时，
+    脚本报告为 ===OK=== 的文件也会逐个重新处理，结果与单文件模式一致。
+    """
+    global _worker_batch_disabled
+    if len(file_paths_abs) == 1 or _worker_batch_disabled:
+        return [process_file_with_editor(fp) for fp in file_paths_abs]
+
+    batch_timeout = _worker_timeout_seconds * len(file_paths_abs)
+
+    list_fd, list_path = tempfile.mkstemp(prefix="efx_batch_", suffix=".txt")
+    try:
+        with os.fdopen(list_fd, "w", encoding="utf-8", newline="\n") as list_f:
+            list_f.write(f"{_worker_template_file}\n")
+            for fp in file_paths_abs:
+                list_f.write(f"{fp}\n")
+
+        command = [str(_worker_editor_exe), f"-script:{BATCH_SCRIPT_FILE}:({list_path})", *_worker_editor_flags]
+
+        timed_out = False
+        try:
+            process = subprocess.run(
+                command,
+                capture_output=True, # 以 bytes 捕获输出，不做整段解码
+                timeout=batch_timeout
+            )
+            stdout, stderr, returncode = process.stdout or b"", process.stderr or b"", process.returncode
+        except subprocess.TimeoutExpired as e:
+            # 超时时 e.stdout/e.stderr 为已捕获的部分输出
+            stdout, stderr = e.stdout or b"", e.stderr or b""
+            returncode = None
+            timed_out = True
+        except Exception:
+            # 编辑器无法启动等情况：逐个文件处理，以便为每个文件给出准确的错误信息
+            return [process_file_with_editor(fp) for fp in file_paths_abs]
+    finally:
+        try:
+            os.remove(list_path)
+        except OSError:
+            pass
+
+    # --- 按标记拆分脚本输出 ---
+    finished_segments = [] # [(标记, 该文件的输出)]
+    current_lines = None   # 已开始但尚未结束的文件的输出行
+    for line in stdout.splitlines():
+        if line.startswith(BATCH_FATAL_MARK):
+            # 脚本根本没有开始处理文件：提示一次，本进程之后的批次都直接逐个文件处理，
+            # 避免每个批次都白白多启动一次010 Editor
+            _worker_batch_disabled = True
+            print(f"警告: 批处理脚本无法运行 ({line.decode('utf-8', 'replace')})，"
+                  f"工作进程 {os.getpid()} 将改为每个文件单独启动010 Editor。")
+            return [process_file_with_editor(fp) for fp in file_paths_abs]
+        if line == BATCH_BEGIN_MARK:
+            current_lines = []
+        elif current_lines is not None and line in (BATCH_OK_MARK, BATCH_ERR_MARK):
+            finished_segments.append((line, b"\n".join(current_lines)))
+            current_lines = None
+        elif current_lines is not None:
+            current_lines.append(line)
+
+    # 超时 (returncode 为 None) 本身不说明已完成的文件有问题，不触发重新处理
+    recheck_ok = (returncode is not None and returncode != 0) or ERROR_KEYWORD_RE.search(stderr) is not None
+
+    results = []
+    for fp, (mark, segment_output) in zip(file_paths_abs, finished_segments):
+        if mark == BATCH_OK_MARK and recheck_ok:
+            results.append(process_file_with_editor(fp))
+            continue
+        result = _new_result(fp)
+        if mark == BATCH_OK_MARK:
+            _classify_result(result, 0, segment_output, b"")
+        else:
+            result["stdout"] = _decode_output(segment_output)
+            result["message"] = "010 Editor 脚本报告模板运行失败。请检查输出。"
+        results.append(result)
+
+    remaining = file_paths_abs[len(results):]
+    if remaining and current_lines is not None:
+        # 脚本在处理该文件时中断 (模板导致脚本终止、编辑器崩溃或超时)
+        result = _new_result(remaining[0])
+        result["stdout"] = _decode_output(b"\n".join(current_lines))
+        result["stderr"] = _decode_output(stderr)
+        if timed_out:
+            result["message"] = f"批处理超时（{batch_timeout}秒），在处理此文件时中断。"
+        else:
+            result["message"] = f"批处理在处理此文件时中断，返回码: {returncode}。请检查输出。"
+        results.append(result)
+        remaining = remaining[1:]
+
+    # 未被脚本处理到的文件回退为逐个文件处理
+    for fp in remaining:
+        results.append(process_file_with_editor(fp))
+    return results
+
+
+# --- 工作进程任务入口：处理一批文件并写入本进程的局部日志 ---
+def validate_batch(file_paths_abs: list) -> list:
+    """
+    处理一批文件 (见 process_batch_with_editor)，把每个结果写入本进程的局部日志文件，
+    返回去掉 stdout/stderr 的精简结果列表，供主进程显示进度和生成总结。
+    需要排序时，MD 行以 "路径\t行" 的形式写入，由主进程合并时排序。
+    每批结束时刷新局部日志：工作进程被强制终止时，已返回给主进程的结果不会丢失在写缓冲中。
+    """
+    results = process_batch_with_editor(file_paths_abs)
+    for result in results:
+        md_row = format_md_row(result)
+        if _worker_sort_md_results:
+            _worker_md_f.write(f"{result['path']}\t{md_row}")
+        else:
+            _worker_md_f.write(md_row)
+        if result['status'] == "OK":
+            _worker_ok_f.write(f"{result['path']}\n")
+        else:
+            _worker_error_f.write(f"{result['path']}\n")
+        del result['stdout'], result['stderr'] # 输出已写入日志，无需再传回主进程
+    _worker_md_f.flush()
+    _worker_ok_f.flush()
+    _worker_error_f.flush()
+    return results
+
+
+# --- 帮助函数：合并OK/Error局部列表 ---
+def merge_partial_lists(partial_paths: list, log_f) -> int:
+    """把各工作进程的局部列表文件依次追加到 log_f，返回写入的行数。"""
+    line_count = 0
+    for partial_path in partial_paths:
+        with open(partial_path, "r", encoding="utf-8") as partial_f:
+            lines = partial_f.readlines()
+        log_f.writelines(lines)
+        line_count += len(lines)
+    return line_count
+
+
 # --- 主验证函数 ---
 def validate_templates():
     print("--- 010 Editor 模板批量验证器 (多日志版 v2) ---")
@@ -185,9 +494,10 @@ def validate_templates():
 
     test_data_dir_str = get_user_input("测试数据根目录", default_test_data_dir)
     test_data_dir = Path(test_data_dir_str) if test_data_dir_str else Path(default_test_data_dir)
+    test_data_dir_abs = test_data_dir.resolve() # 只解析一次，后续文件路径均基于它用字符串拼接
     
     # 日志基础目录，默认为测试数据目录下的 "validation_logs" 子文件夹
-    default_log_base_dir_for_prompt = test_data_dir.resolve() / "validation_logs"
+    default_log_base_dir_for_prompt = test_data_dir_abs / "validation_logs"
     log_base_dir_str = get_user_input("日志文件存放目录", str(default_log_base_dir_for_prompt))
     log_base_dir = Path(log_base_dir_str) if log_base_dir_str else default_log_base_dir_for_prompt
 
@@ -195,7 +505,7 @@ def validate_templates():
     print(f"\n当前配置:")
     print(f"  编辑器: {editor_exe.resolve()}")
     print(f"  模板: {template_file.resolve()}")
-    print(f"  数据目录: {test_data_dir.resolve()}")
+    print(f"  数据目录: {test_data_dir_abs}")
     print(f"  日志目录: {log_base_dir.resolve()}\n")
 
     process_recursively = get_user_input("是否递归处理子目录? (yes/no)", "yes", input_type=bool)
@@ -208,9 +518,28 @@ def validate_templates():
     use_noui = get_user_input("是否使用 -noui (无界面模式)? (yes/no)", "yes", input_type=bool)
     use_exit_param = get_user_input("是否使用 -exit (010Editor处理后退出)? (yes/no)", "no", input_type=bool)
     timeout_seconds = get_user_input("单个文件处理超时时间 (秒)", 60, input_type=int)
-    num_threads_default = os.cpu_count()
-    if num_threads_default is None: num_threads_default = 4 # Fallback if cpu_count fails
+    cpu_count = os.cpu_count()
+    if cpu_count is None: cpu_count = 4 # Fallback if cpu_count fails
+    num_threads_default = max(1, cpu_count - 1) # 留出一个核心保持系统响应
+    if sys.platform == "win32":
+        num_threads_default = min(num_threads_default, WINDOWS_MAX_WORKERS)
     num_threads = get_user_input("并行线程数", num_threads_default, input_type=int)
+    if num_threads > cpu_count:
+        # 每个线程都会启动一个010 Editor进程，超过CPU核心数只会增加上下文切换而不会更快
+        if os.environ.get("ALLOW_OVERSUBSCRIBE") == "1":
+            print(f"警告: 并行线程数 {num_threads} 超过CPU核心数 {cpu_count}，因设置了 ALLOW_OVERSUBSCRIBE=1 将按原值运行。")
+        else:
+            print(f"警告: 并行线程数 {num_threads} 超过CPU核心数 {cpu_count}，将限制为 {cpu_count}。(设置环境变量 ALLOW_OVERSUBSCRIBE=1 可取消此限制)")
+            num_threads = cpu_count
+    if sys.platform == "win32" and num_threads > WINDOWS_MAX_WORKERS:
+        # 此限制来自 Python 本身，ALLOW_OVERSUBSCRIBE 也无法取消
+        print(f"警告: Windows 上最多只能使用 {WINDOWS_MAX_WORKERS} 个工作进程，并行线程数 {num_threads} 将限制为 {WINDOWS_MAX_WORKERS}。")
+        num_threads = WINDOWS_MAX_WORKERS
+    batch_size = get_user_input("每次启动010 Editor处理的文件数 (1 = 每个文件单独启动; 大于1 = 使用批处理脚本)", 1, input_type=int)
+    if batch_size < 1:
+        print("批处理文件数必须为正整数，将使用 1。")
+        batch_size = 1
+    sort_md_results = get_user_input("是否在处理完成后按文件路径排序主日志中的结果? (yes/no)", "yes", input_type=bool)
 
     # --- 验证路径 ---
     if not editor_exe.exists() or not editor_exe.is_file():
@@ -222,6 +551,9 @@ def validate_templates():
     if not test_data_dir.exists() or not test_data_dir.is_dir():
         print(f"错误: 测试数据目录未找到或不是一个目录: '{test_data_dir}'")
         sys.exit(1)
+    if batch_size > 1 and not BATCH_SCRIPT_FILE.is_file():
+        print(f"错误: 批处理模式所需的脚本文件未找到: '{BATCH_SCRIPT_FILE}'")
+        sys.exit(1)
 
     try:
         log_base_dir.mkdir(parents=True, exist_ok=True)
@@ -231,14 +563,16 @@ def validate_templates():
         sys.exit(1)
 
     # --- 生成带时间戳的日志文件名 ---
+    import datetime # 用于生成带时间戳的文件名；延迟到参数验证通过后再导入
     timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
     md_log_file_path = log_base_dir / f"validation_log_{timestamp}.md"
     ok_files_log_path = log_base_dir / f"ok_files_{timestamp}.txt"
     error_files_log_path = log_base_dir / f"error_files_{timestamp}.txt"
+    partials_dir = log_base_dir / f".partials_{timestamp}" # 各工作进程的局部日志，处理完成后合并并删除
 
 
     # --- 加载先前OK的文件列表 (如果用户选择跳过) ---
-    previously_ok_abs_paths = set()
+    previously_ok_abs_paths = frozenset()
     if skip_ok_files:
         previously_ok_abs_paths = load_previously_ok_files_from_txt(log_base_dir)
 
@@ -251,6 +585,9 @@ def validate_templates():
             is_regex_pattern = True
             pattern_type_message = f"使用正则表达式模式: `{file_pattern_str}`"
         else:
+            # 预先把 Glob 模式翻译为正则表达式，文件过滤时与正则模式走同一条 match 路径。
+            # fnmatch.fnmatch 在 Windows 上不区分大小写，这里用 IGNORECASE 保持一致。
+            file_regex = re.compile(fnmatch.translate(file_pattern_str), re.IGNORECASE if os.name == "nt" else 0)
             is_regex_pattern = False
             pattern_type_message = f"使用Glob通配符模式: `{file_pattern_str}`"
         print(pattern_type_message.replace('`',''))
@@ -264,34 +601,19 @@ def validate_templates():
 
     # --- 文件发现与过滤 ---
     print("\n正在发现文件...")
-    all_found_files = []
-    if process_recursively:
-        for p_root, _, p_filenames in os.walk(test_data_dir):
-            for p_filename in p_filenames:
-                all_found_files.append(Path(p_root) / p_filename)
-    else:
-        for p_item in test_data_dir.iterdir():
-            if p_item.is_file():
-                all_found_files.append(p_item)
-    
-    files_to_process_initially = [] 
-    for file_path_obj in all_found_files: # 使用更有意义的变量名
-        filename_only = file_path_obj.name
-        if is_regex_pattern:
-            if file_regex.match(filename_only):
-                files_to_process_initially.append(file_path_obj)
-        else:
-            if glob.fnmatch.fnmatch(filename_only, file_pattern_str):
-                files_to_process_initially.append(file_path_obj)
+    # 所有路径都是基于 test_data_dir_abs 拼接出的绝对路径字符串，无需再调用 resolve()
+    files_to_process_initially = discover_matching_files(
+        str(test_data_dir_abs), file_regex.match, process_recursively, min(32, num_threads * 2)
+    )
     
     initial_match_count = len(files_to_process_initially)
     skipped_count = 0
     files_to_process_final = []
 
     if skip_ok_files and previously_ok_abs_paths:
-        for fp_obj in files_to_process_initially:
-            if fp_obj.resolve() not in previously_ok_abs_paths:
-                files_to_process_final.append(fp_obj)
+        for fp_str in files_to_process_initially:
+            if ok_list_key(fp_str) not in previously_ok_abs_paths:
+                files_to_process_final.append(fp_str)
             else:
                 skipped_count += 1
         print(f"根据先前OK文件列表，将跳过 {skipped_count} 个文件。")
@@ -307,10 +629,10 @@ def validate_templates():
             log_f.write(f"## 配置\n")
             log_f.write(f"- **编辑器:** `{editor_exe.resolve()}`\n")
             log_f.write(f"- **模板:** `{template_file.resolve()}`\n")
-            log_f.write(f"- **数据目录 (根):** `{test_data_dir.resolve()}`\n")
+            log_f.write(f"- **数据目录 (根):** `{test_data_dir_abs}`\n")
             log_f.write(f"- **文件匹配模式:** `{file_pattern_str}`\n")
             log_f.write(f"- **跳过先前OK文件:** {'是' if skip_ok_files else '否'}\n")
-            log_f.write(f"\n在 `{test_data_dir.resolve()}` 中没有找到与模式 `{file_pattern_str}` 匹配且需要处理的文件。\n")
+            log_f.write(f"\n在 `{test_data_dir_abs}` 中没有找到与模式 `{file_pattern_str}` 匹配且需要处理的文件。\n")
             if initial_match_count > 0 and skipped_count == initial_match_count:
                 log_f.write(f"总共匹配到 {initial_match_count} 个文件，全部因先前在OK列表中而被跳过。\n")
         sys.exit(0)
@@ -318,20 +640,20 @@ def validate_templates():
     print(f"共发现 {initial_match_count} 个匹配模式的文件。")
     if skipped_count > 0:
         print(f"跳过了 {skipped_count} 个先前在OK列表中的文件。")
-    print(f"准备处理 {actual_files_to_process_count} 个文件，使用 {num_threads} 个线程...")
+    print(f"准备处理 {actual_files_to_process_count} 个文件，使用 {num_threads} 个工作进程...")
 
     # --- 初始化日志文件 ---
-    processed_results = [] # 存储所有线程的结果
+    error_results = [] # 只保留非OK结果 (不含输出)，用于最后的总结
     
-    with open(md_log_file_path, "w", encoding="utf-8") as md_log_f, \
-         open(ok_files_log_path, "w", encoding="utf-8") as ok_log_f, \
-         open(error_files_log_path, "w", encoding="utf-8") as error_log_f:
+    with open(md_log_file_path, "w", encoding="utf-8", buffering=LOG_BUFFER_SIZE) as md_log_f, \
+         open(ok_files_log_path, "w", encoding="utf-8", buffering=LOG_BUFFER_SIZE) as ok_log_f, \
+         open(error_files_log_path, "w", encoding="utf-8", buffering=LOG_BUFFER_SIZE) as error_log_f:
 
         md_log_f.write(f"# 010 Editor 模板验证日志 ({timestamp})\n\n")
         md_log_f.write(f"## 配置\n")
         md_log_f.write(f"- **编辑器:** `{editor_exe.resolve()}`\n")
         md_log_f.write(f"- **模板:** `{template_file.resolve()}`\n")
-        md_log_f.write(f"- **数据目录 (根):** `{test_data_dir.resolve()}`\n")
+        md_log_f.write(f"- **数据目录 (根):** `{test_data_dir_abs}`\n")
         md_log_f.write(f"- **递归处理:** {'是' if process_recursively else '否'}\n")
         md_log_f.write(f"- **文件匹配模式:** `{file_pattern_str}` ({'正则表达式' if is_regex_pattern else 'Glob通配符'})\n")
         md_log_f.write(f"- **跳过先前OK文件:** {'是' if skip_ok_files else '否'}")
@@ -345,7 +667,9 @@ def validate_templates():
         md_log_f.write(f"- **使用 -noui:** {'是' if use_noui else '否'}\n")
         md_log_f.write(f"- **使用 -exit:** {'是' if use_exit_param else '否'}\n")
         md_log_f.write(f"- **单个文件超时:** {timeout_seconds}秒\n")
-        md_log_f.write(f"- **线程数:** {num_threads}\n\n")
+        md_log_f.write(f"- **线程数:** {num_threads}\n")
+        md_log_f.write(f"- **按路径排序结果:** {'是' if sort_md_results else '否'}\n")
+        md_log_f.write(f"- **批处理文件数:** {batch_size}{' (每个文件单独启动010 Editor)' if batch_size == 1 else f' (脚本: `{BATCH_SCRIPT_FILE}`)'}\n\n")
         if compile_error_message: 
              md_log_f.write(f"**启动时错误:**\n```\n{compile_error_message}\n```\n\n")
         
@@ -354,74 +678,87 @@ def validate_templates():
             md_log_f.write(f"*注意: 已跳过 {skipped_count} 个先前在OK列表中的文件。*\n\n")
         md_log_f.write("| 状态 | 文件路径 (可点击) | 详情 |\n")
         md_log_f.write("|---|---|---|\n")
-        md_log_f.flush()
-
-        # --- 多线程处理 ---
-        log_lock = threading.Lock() 
-        processed_files_count_current_run = 0
-
-        with ThreadPoolExecutor(max_workers=num_threads) as executor:
-            futures = {
-                executor.submit(
-                    process_file_with_editor,
-                    fp_obj.resolve(), # 确保传入的是绝对路径
-                    editor_exe,
-                    template_file,
-                    use_noui,
-                    use_exit_param,
-                    timeout_seconds,
-                    test_data_dir # 传递 test_data_dir 作为 base_data_dir
-                ): fp_obj for fp_obj in files_to_process_final
-            }
-
-            for i, future in enumerate(as_completed(futures)):
-                result = future.result()
-                processed_results.append(result) # 收集结果
-
-                with log_lock: # 保护计数器和控制台输出
-                    processed_files_count_current_run += 1
-                
-                console_display_path = result['relative_path'] # 使用 result 中已计算好的相对路径
-                print(f"({processed_files_count_current_run}/{actual_files_to_process_count}) {result['status']}: {console_display_path}")
-        
-        # --- 处理完成后，排序并写入日志 ---
-        processed_results.sort(key=lambda r: r['path']) 
-
-        final_ok_list_count = 0
-        final_error_list_count = 0
-
-        for result in processed_results:
-            file_path_abs_str = result['path'] 
-            file_display_name = result['filename']
-            
-            # URL编码路径中的特殊字符，确保Markdown链接正确
-            # 将所有反斜杠替换为正斜杠，然后编码
-            path_for_link = file_path_abs_str.replace(os.sep, '/')
-            file_link_path_encoded = urllib.parse.quote(path_for_link, safe="/:")
-            file_link = f"[{file_display_name}](file:///{file_link_path_encoded})"
-            
-            details_md = result['message']
-            if result['status'] != "OK":
-                if result['stdout']:
-                    details_md += f"<br><br>**标准输出 (Stdout):**<br>```\n{result['stdout']}\n```"
-                if result['stderr']:
-                    details_md += f"<br><br>**标准错误 (Stderr):**<br>```\n{result['stderr']}\n```"
-            
-            details_md_sanitized = details_md.replace("|", "\\|").replace("\n", "<br>")
-            md_log_f.write(f"| {result['status']} | {file_link} | {details_md_sanitized} |\n")
-
-            if result['status'] == "OK":
-                ok_log_f.write(f"{file_path_abs_str}\n")
-                final_ok_list_count += 1
+
+        # --- 多进程处理 ---
+        # 每个任务都会启动外部的 010Editor.exe，而结果解析、关键词扫描和日志行的格式化都在工作进程中完成，
+        # 避免了多线程下 GIL 对这些后处理的串行化。每个工作进程只写自己的局部日志文件，
+        # 主进程只负责计数、打印进度，并在进程池关闭后把局部日志合并到最终日志中。
+        progress_counter = itertools.count(1)
+        pool_broken_message = None
+
+        partials_dir.mkdir()
+        try:
+            with ProcessPoolExecutor(
+                max_workers=num_threads,
+                initializer=init_worker,
+                initargs=(editor_exe, template_file, test_data_dir_abs, use_noui, use_exit_param, timeout_seconds, # test_data_dir 作为 base_data_dir
+                          partials_dir, sort_md_results)
+            ) as executor:
+                # 滑动窗口提交：同时在途的任务数不超过 max_inflight，每完成一个再提交下一个，
+                # 内存占用与文件总数无关，第一个任务也无需等待所有 Future 创建完毕即可开始。
+                max_inflight = 4 * num_threads
+                batch_iter = (
+                    files_to_process_final[i:i + batch_size]
+                    for i in range(0, actual_files_to_process_count, batch_size)
+                )
+                def submit_batch(batch):
+                    inflight[executor.submit(
+                        validate_batch,
+                        batch # 已是绝对路径字符串
+                    )] = batch
+
+                inflight = {}
+                for batch in itertools.islice(batch_iter, max_inflight):
+                    submit_batch(batch)
+
+                while inflight:
+                    done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        del inflight[future]
+                        next_batch = next(batch_iter, None)
+                        if next_batch is not None:
+                            submit_batch(next_batch)
+
+                        for result in future.result():
+                            is_ok = result['status'] == "OK"
+                            if not is_ok:
+                                error_results.append(result)
+
+                            # 进度输出节流：非OK结果、每 PROGRESS_PRINT_INTERVAL 个以及最后一个才打印
+                            idx = next(progress_counter)
+                            if not is_ok or idx % PROGRESS_PRINT_INTERVAL == 0 or idx == actual_files_to_process_count:
+                                console_display_path = result['relative_path'] # 使用 result 中已计算好的相对路径
+                                print(f"({idx}/{actual_files_to_process_count}) {result['status']}: {console_display_path}")
+        except BrokenProcessPool:
+            # 某个工作进程被强制终止 (例如被系统杀死)：停止处理，保留已完成的结果并照常写出总结
+            pool_broken_message = "有工作进程异常终止，处理已中断。"
+            print(f"\n错误: {pool_broken_message}")
+        finally:
+            # --- 进程池关闭 (工作进程已退出并关闭各自的局部日志) 后，合并局部日志 ---
+            # 即使处理中途出错或被 Ctrl-C 中断，也会合并已有的结果 (OK列表中只有真正通过的文件)，并清理临时目录。
+            # 总结中的计数以实际写入列表的行数为准
+            final_ok_list_count = merge_partial_lists(sorted(partials_dir.glob("ok_*.txt")), ok_log_f)
+            final_error_list_count = merge_partial_lists(sorted(partials_dir.glob("error_*.txt")), error_log_f)
+
+            md_partial_paths = sorted(partials_dir.glob("md_*.part"))
+            if sort_md_results:
+                # 只对 (路径, 行) 排序，然后去掉路径前缀写入主日志
+                md_entries = []
+                for partial_path in md_partial_paths:
+                    with open(partial_path, "r", encoding="utf-8") as partial_f:
+                        # 进程被强制终止时最后一行可能不完整，跳过这样的行
+                        md_entries.extend(line.split("\t", 1) for line in partial_f if "\t" in line and line.endswith("\n"))
+                md_entries.sort()
+                md_log_f.writelines(md_row for _, md_row in md_entries)
+                del md_entries
             else:
-                error_log_f.write(f"{file_path_abs_str}\n")
-                final_error_list_count +=1
-        
-        md_log_f.flush()
-        ok_log_f.flush()
-        error_log_f.flush()
+                for partial_path in md_partial_paths:
+                    with open(partial_path, "r", encoding="utf-8") as partial_f:
+                        shutil.copyfileobj(partial_f, md_log_f)
+            shutil.rmtree(partials_dir, ignore_errors=True)
 
         # --- 总结 ---
+        processed_files_count_current_run = final_ok_list_count + final_error_list_count
         md_log_f.write(f"\n## 验证总结\n")
         md_log_f.write(f"- 匹配模式的文件总数: {initial_match_count}\n")
         if skipped_count > 0:
@@ -429,17 +766,17 @@ def validate_templates():
         md_log_f.write(f"- 本次实际处理的文件数: {processed_files_count_current_run}\n")
         md_log_f.write(f"- 本次处理结果OK的文件数: {final_ok_list_count}\n")
         md_log_f.write(f"- 本次处理结果非OK的文件数: {final_error_list_count}\n")
+        if pool_broken_message:
+            unprocessed_count = actual_files_to_process_count - processed_files_count_current_run
+            md_log_f.write(f"- **{pool_broken_message}** 剩余 {unprocessed_count} 个文件未处理，可跳过OK文件后重新运行。\n")
 
 
         if final_error_list_count > 0:
             md_log_f.write(f"- **发现错误、警告或超时的文件 ({final_error_list_count} 个):**\n")
             print(f"\n--- 发现错误、警告或超时的文件 ({final_error_list_count} 个): ---")
-            # 从 processed_results 中筛选出错误项，用于总结
-            error_summary_items = [res for res in processed_results if res['status'] != "OK"]
-            for i, res in enumerate(error_summary_items):
-                path_for_summary_link = res['path'].replace(os.sep, '/')
-                file_link_path_encoded_summary = urllib.parse.quote(path_for_summary_link, safe='/:')
-                file_link_summary = f"[{res['filename']}](file:///{file_link_path_encoded_summary})"
+            error_results.sort(key=lambda r: r['path'])
+            for i, res in enumerate(error_results):
+                file_link_summary = markdown_file_link(res['path'], res['filename'])
 
                 md_log_f.write(f"  {i+1}. {file_link_summary} - {res['status']}: {res['message']}\n")
                 